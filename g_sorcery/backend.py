@@ -12,23 +12,161 @@
 """
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import itertools
+import multiprocessing
 import os
 import pathlib
+import queue
 import shutil
 import subprocess
+import threading
+import weakref
 
 import portage
 
 from .compatibility import configparser
-from .g_collections import Package, elist
-from .fileutils import fast_manifest, FileJSON
+from .g_collections import Package
+from .fileutils import fast_manifest, FileJSON, MANIFEST_HASHES
 from .exceptions import DependencyError, DigestError, InvalidKeyError
-from .logger import Logger
+from .logger import Logger, LogBuffer
 from .mangler import package_managers
 from .package_db import PackageDB
 
 
+# Generators used by rendering worker processes, set by _init_renderers.
+_renderers = (None, None)
+
+# Minimal number of packages rendered by a pool of worker processes.
+_RENDER_POOL_THRESHOLD = 32
+
+def _init_renderers(ebuild_g, metadata_g):
+    """
+    Initialize a rendering worker process.
+
+    Args:
+        ebuild_g: Ebuild generator or None.
+        metadata_g: Metadata generator or None.
+    """
+    global _renderers
+    _renderers = (ebuild_g, metadata_g)
+
+def _render_chunk(packages):
+    """
+    Render ebuilds and metadata for packages in a worker process.
+
+    Args:
+        packages: List of g_collections.Package instances.
+
+    Returns:
+        List of triples, see _render_package.
+    """
+    return [_render_package(*_renderers, package) for package in packages]
+
+def _render_package(ebuild_g, metadata_g, package):
+    """
+    Render ebuild and metadata for a package.
+
+    Args:
+        ebuild_g: Ebuild generator or None.
+        metadata_g: Metadata generator or None.
+        package: g_collections.Package instance.
+
+    Returns:
+        A triple (package, ebuild, metadata) with sources encoded as utf-8
+    bytes, None for sources without a generator.
+    """
+    ebuild = metadata = None
+    if ebuild_g is not None:
+        ebuild = '\n'.join(ebuild_g.generate(package)).encode('utf-8')
+    if metadata_g is not None:
+        metadata = '\n'.join(metadata_g.generate(package)).encode('utf-8')
+    return (package, ebuild, metadata)
+
+def _remove_path(path):
+    """
+    Remove a file or a directory tree.
+
+    Args:
+        path: pathlib.Path to remove.
+    """
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+def _write_file(path, data):
+    """
+    Write data to a file, bypassing Python file objects.
+
+    Args:
+        path: File path.
+        data: Bytes to write.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def _write_lines(path, lines):
+    """
+    Write lines separated by newlines to a file encoded as utf-8.
+
+    Lines are streamed to a buffered file without joining them first.
+
+    Args:
+        path: File path.
+        lines: Iterable of strings.
+    """
+    def encoded():
+        for i, line in enumerate(lines):
+            if i:
+                yield b'\n'
+            yield line.encode('utf-8')
+
+    with open(path, 'wb', buffering=64 * 1024) as f:
+        f.writelines(encoded())
+
+@contextlib.contextmanager
+def _file_writer(maxsize=256):
+    """
+    Write files from a dedicated thread.
+
+    The context manager provides a function write(path, data) that queues
+    data to be written, the first write error is raised on exit.
+
+    Args:
+        maxsize: Maximal number of pending writes.
+    """
+    write_q = queue.Queue(maxsize=maxsize)
+    errors = []
+
+    def consume():
+        # keep draining after a failure, so that the producer never blocks
+        while (item := write_q.get()) is not None:
+            if not errors:
+                try:
+                    _write_file(*item)
+                except Exception as e:
+                    errors.append(e)
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    try:
+        yield lambda path, data: write_q.put((path, data))
+    finally:
+        write_q.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
 class Backend(object):
     """
     Backend for a repository.
@@ -59,6 +197,10 @@ class Backend(object):
         self.ebuild_g_without_digest_class = ebuild_g_without_digest_class
         self.eclass_g_class = eclass_g_class
         self.metadata_g_class = metadata_g_class
+        self._catindex_cache = weakref.WeakKeyDictionary()
+        self._desc_cache = weakref.WeakKeyDictionary()
+        self._generators_db = None
+        self._generators = {}
 
         self.parser = \
             argparse.ArgumentParser(description='Automatic ebuild generator.')
@@ -114,11 +256,10 @@ class Backend(object):
                 return None
             else:
                 overlay = config['default_overlay']
-        overlay = args.overlay
         overlay = os.path.abspath(overlay)
         return overlay
 
-    def _get_package_db(self, args, config, global_config):
+    def _get_package_db(self, args, config, global_config, overlay=None):
         """
         Get package database object.
 
@@ -126,11 +267,13 @@ class Backend(object):
             args: Command line arguments.
             config: Backend config.
             global_config: g-sorcery config.
+            overlay: Overlay directory, looked up if not given.
 
         Returns:
             Package database object.
         """
-        overlay = self._get_overlay(args, config, global_config)
+        if overlay is None:
+            overlay = self._get_overlay(args, config, global_config)
         backend_path = os.path.join(overlay,
                             self.sorcery_dir, config["package"])
         repository = args.repository
@@ -234,7 +377,8 @@ class Backend(object):
             Exit status.
         """
         overlay = self._get_overlay(args, config, global_config)
-        pkg_db = self._get_package_db(args, config, global_config)
+        pkg_db = self._get_package_db(args, config, global_config,
+                                      overlay=overlay)
         pkg_db.read()
 
         pkgname = args.pkgname
@@ -247,14 +391,41 @@ class Backend(object):
 
         eclasses = []
         for package in dependencies:
-            eclasses += pkg_db.get_package_description(package)['eclasses']
+            eclasses += self._get_package_description(pkg_db,
+                                                      package)['eclasses']
         eclasses = list(set(eclasses))
         self.generate_eclasses(overlay, eclasses)
-        self.generate_ebuilds(pkg_db, overlay, dependencies, True)
-        self.generate_metadatas(pkg_db, overlay, dependencies)
+        self.generate_packages(pkg_db, overlay, dependencies, True)
         self.digest(overlay, erase=args.erase)
         return 0
 
+    def generate_packages(self, package_db, overlay, packages, digest=False):
+        """
+        Generate ebuilds and metadata files for given packages.
+
+        Both are rendered by a single worker pool.
+
+        Args:
+            package_db: Package database
+            overlay: Overlay directory.
+            packages: List of packages.
+            digest: whether sources should be digested in Manifest.
+        """
+        self.logger.info("ebuild and metadata generation")
+        ebuild_g = self._get_ebuild_generator(package_db, digest)
+        metadata_g = self._get_generator(self.metadata_g_class, package_db)
+        for package, ebuild, metadata in self._render(
+                packages, ebuild_g=ebuild_g, metadata_g=metadata_g):
+            self.logger.info("    generating " + str(package))
+            path = os.path.join(overlay, package.category, package.name)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            with open(os.path.join(path, package.name + '-'
+                                   + package.version + '.ebuild'), 'wb') as f:
+                f.write(ebuild)
+            with open(os.path.join(path, 'metadata.xml'), 'wb') as f:
+                f.write(metadata)
+
     def generate_ebuilds(self, package_db, overlay, packages, digest=False):
         """
         Generate ebuilds for given packages.
@@ -267,11 +438,8 @@ class Backend(object):
         """
 
         self.logger.info("ebuild generation")
-        if digest:
-            ebuild_g = self.ebuild_g_with_digest_class(package_db)
-        else:
-            ebuild_g = self.ebuild_g_without_digest_class(package_db)
-        for package in packages:
+        ebuild_g = self._get_ebuild_generator(package_db, digest)
+        for package, source, _ in self._render(packages, ebuild_g=ebuild_g):
             category = package.category
             name = package.name
             version = package.version
@@ -280,10 +448,9 @@ class Backend(object):
             path = os.path.join(overlay, category, name)
             if not os.path.exists(path):
                 os.makedirs(path)
-            source = ebuild_g.generate(package)
             with open(os.path.join(path,
-                        name + '-' + version + '.ebuild'), 'w') as f:
-                f.write('\n'.join(source))
+                        name + '-' + version + '.ebuild'), 'wb') as f:
+                f.write(source)
 
 
     def generate_metadatas(self, package_db, overlay, packages):
@@ -296,14 +463,111 @@ class Backend(object):
             packages: List of packages.
         """
         self.logger.info("metadata generation")
-        metadata_g = self.metadata_g_class(package_db)
-        for package in packages:
+        metadata_g = self._get_generator(self.metadata_g_class, package_db)
+        for package, _, source in self._render(packages,
+                                               metadata_g=metadata_g):
             path = os.path.join(overlay, package.category, package.name)
             if not os.path.exists(path):
                 os.makedirs(path)
-            source = metadata_g.generate(package)
-            with open(os.path.join(path, 'metadata.xml'), 'w') as f:
-                f.write('\n'.join(source))
+            with open(os.path.join(path, 'metadata.xml'), 'wb') as f:
+                f.write(source)
+
+    def _get_ebuild_generator(self, package_db, digest):
+        """
+        Get an ebuild generator for a package database.
+
+        Args:
+            package_db: Package database.
+            digest: whether sources should be digested in Manifest.
+
+        Returns:
+            Ebuild generator instance.
+        """
+        if digest:
+            return self._get_generator(self.ebuild_g_with_digest_class,
+                                       package_db)
+        return self._get_generator(self.ebuild_g_without_digest_class,
+                                   package_db)
+
+    def _get_generator(self, generator_class, package_db):
+        """
+        Get an ebuild or metadata generator for a package database.
+
+        Generators are reused as long as the same package database is used.
+
+        Args:
+            generator_class: Generator class.
+            package_db: Package database.
+
+        Returns:
+            Instance of generator_class.
+        """
+        if self._generators_db is not package_db:
+            self._generators_db = package_db
+            self._generators = {}
+        if generator_class not in self._generators:
+            self._generators[generator_class] = generator_class(package_db)
+        return self._generators[generator_class]
+
+    @functools.cached_property
+    def _eclass_g(self):
+        """
+        Eclass generator.
+        """
+        return self.eclass_g_class()
+
+    def _render(self, packages, ebuild_g=None, metadata_g=None):
+        """
+        Render ebuilds and metadata for given packages in parallel.
+
+        Rendering is done in forked worker processes, which inherit the
+        generators and their package database. Only packages and rendered
+        sources travel between processes.
+
+        Args:
+            packages: Iterable of packages.
+            ebuild_g: Ebuild generator, ebuilds are not rendered if None.
+            metadata_g: Metadata generator, metadata is not rendered if None.
+
+        Returns:
+            Iterator over triples (package, ebuild, metadata) in the order
+        of packages, sources are utf-8 encoded bytes.
+
+        Note:
+            Worker processes are forked before this method returns, so it
+        should be called before starting any threads. A few packages
+        are rendered in-process, as forking would cost more.
+        """
+        packages = list(packages)
+        if len(packages) < _RENDER_POOL_THRESHOLD:
+            return (_render_package(ebuild_g, metadata_g, package)
+                    for package in packages)
+
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_renderers,
+            initargs=(ebuild_g, metadata_g))
+        futures = [executor.submit(_render_chunk, packages[i:i + 64])
+                   for i in range(0, len(packages), 64)]
+
+        def stop():
+            # do not wait for pending packages if the caller stopped early
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        def drain():
+            try:
+                for future in futures:
+                    yield from future.result()
+            finally:
+                finalizer()
+
+        drained = drain()
+        # the finally clause does not run if drained is never iterated
+        finalizer = weakref.finalize(drained, stop)
+        return drained
 
     def generate_eclasses(self, overlay, eclasses):
         """
@@ -314,29 +578,76 @@ class Backend(object):
             eclasses: List of eclasses.
         """
         self.logger.info("eclasses generation")
-        eclass_g = self.eclass_g_class()
+        eclass_g = self._eclass_g
         path = os.path.join(overlay, 'eclass')
         if not os.path.exists(path):
             os.makedirs(path)
         for eclass in eclasses:
             self.logger.info("    generating " + eclass + " eclass")
             source = eclass_g.generate(eclass)
-            with open(os.path.join(path, eclass + '.eclass'), 'w') as f:
-                f.write('\n'.join(source))
+            _write_lines(os.path.join(path, eclass + '.eclass'), source)
 
 
-    def get_dependencies(self, package_db, pkgname):
+    def _catindex(self, package_db):
+        """
+        Get an index of categories by package name.
+
+        The index is built once per package database and rebuilt
+        only when the database generation changes.
+
+        Args:
+            package_db: Package database.
+
+        Returns:
+            Dictionary mapping package names to lists of categories.
+        """
+        cached = self._catindex_cache.get(package_db)
+        if cached and cached[0] == package_db.generation:
+            return cached[1]
+        index = {}
+        for catpkg in package_db.list_catpkg_names():
+            category, name = catpkg.split('/', 1)
+            index.setdefault(name, []).append(category)
+        self._catindex_cache[package_db] = (package_db.generation, index)
+        return index
+
+    def _get_package_description(self, package_db, package):
+        """
+        Get package ebuild data, memoized per package database generation.
+
+        Returned dictionaries are shared between callers and must not
+        be modified.
+
+        Args:
+            package_db: Package database.
+            package: g_collections.Package instance.
+
+        Returns:
+            Dictionary with package ebuild data.
+        """
+        generation, cache = self._desc_cache.get(package_db, (None, None))
+        if generation != package_db.generation:
+            cache = {}
+            self._desc_cache[package_db] = (package_db.generation, cache)
+        if package not in cache:
+            cache[package] = package_db.get_package_description(package)
+        return cache[package]
+
+    def get_dependencies(self, package_db, pkgname, solved_deps=None):
         """
         Get dependencies for a given package.
 
         Args:
             package_db: Database.
             pkgname: package name (string).
+            solved_deps: Set of packages with already solved dependencies,
+        those are not expanded again. Updated in place.
 
         Returns:
             A set containing dependencies (instances of Package).
         Package version is ignored currently and a returned set contains all
-        the versions of packages pkgname depends on.
+        the versions of packages pkgname depends on. If solved_deps is given
+        it is returned extended by those dependencies.
         """
         parts = pkgname.split('/')
         category = None
@@ -351,11 +662,7 @@ class Backend(object):
             raise DependencyError(error)
 
         if not category:
-            all_categories = package_db.list_categories()
-            categories = []
-            for cat in all_categories:
-                if package_db.in_category(cat, name):
-                    categories.append(cat)
+            categories = self._catindex(package_db).get(name, [])
 
             if not len(categories):
                 error = 'no package with name ' \
@@ -373,11 +680,79 @@ class Backend(object):
 
             category = categories[0]
         versions = package_db.list_package_versions(category, name)
+        if solved_deps is None:
+            solved_deps = set()
+
+        # Discover the whole dependency graph once, breadth first. Edges
+        # are stored in both directions, reversed ones go from a dependency
+        # to its dependents.
+        versions_cache = {}
+        in_degree = {}
+        graph = {}
+        reverse_graph = collections.defaultdict(list)
+        missing = set()
+        roots = (Package(category, name, version) for version in versions)
+        pending = collections.deque(package for package in roots
+                                    if package not in solved_deps)
+        enqueued = set(pending)
+        while pending:
+            package = pending.popleft()
+            try:
+                desc = self._get_package_description(package_db, package)
+            except KeyError:
+                self.logger.error("package " + str(package) + " not found")
+                # at the moment ignore unsolved dependencies, as those deps can be in other repo
+                # or can be external: portage will catch it
+                missing.add(package)
+                continue
+            deps = set()
+            for dep in desc["dependencies"]:
+                key = (dep.category, dep.package)
+                if key not in versions_cache:
+                    try:
+                        versions_cache[key] = \
+                            package_db.list_package_versions(*key)
+                    except InvalidKeyError:
+                        # ignore non existing packages
+                        versions_cache[key] = []
+                for version in versions_cache[key]:
+                    pkg = Package(dep.category, dep.package, version)
+                    if pkg not in solved_deps:
+                        deps.add(pkg)
+            in_degree[package] = len(deps)
+            graph[package] = deps
+            for dep in deps:
+                reverse_graph[dep].append(package)
+                if dep not in enqueued:
+                    enqueued.add(dep)
+                    pending.append(dep)
+
+        # Kahn's algorithm: missing packages count as solved leaves.
+        ready = collections.deque(missing)
+        ready.extend(package for package, degree in in_degree.items()
+                     if not degree)
         dependencies = set()
-        for version in versions:
-            dependencies |= self.solve_dependencies(package_db,
-                                    Package(category, name, version))[0]
-        return dependencies
+        while ready:
+            package = ready.popleft()
+            if package not in missing:
+                dependencies.add(package)
+            for dependent in reverse_graph[package]:
+                in_degree[dependent] -= 1
+                if not in_degree[dependent]:
+                    ready.append(dependent)
+
+        if len(dependencies) < len(in_degree):
+            # Every leftover package depends on another leftover one, so
+            # following those dependencies ends up going round a cycle.
+            leftover = set(in_degree) - dependencies
+            package = min(leftover, key=str)
+            visited = set()
+            while package not in visited:
+                visited.add(package)
+                package = min(leftover & graph[package], key=str)
+            raise DependencyError('circular dependency for ' + str(package))
+        solved_deps |= dependencies
+        return solved_deps
 
     def solve_dependencies(self, package_db, package,
                            solved_deps=None, unsolved_deps=None):
@@ -387,55 +762,76 @@ class Backend(object):
         Args:
             package_db: Package database.
             package: A package we want to solve dependencies for.
-            solved_deps: List of solved dependencies.
-            unsolved_deps: List of dependencies to be solved.
+            solved_deps: Set of solved dependencies, updated in place.
+            unsolved_deps: Set of dependencies being solved, updated in place.
 
         Returns:
             A pair (solved_deps, unsolved_deps).
 
         Note:
             Each dependency is an object of class g_collections.Dependency.
+            The graph is walked depth first with an explicit stack, packages
+            are added to solved_deps in post-order.
         """
-        if not solved_deps:
+        if solved_deps is None:
             solved_deps = set()
-        if not unsolved_deps:
+        if unsolved_deps is None:
             unsolved_deps = set()
-        if package in solved_deps:
-            return solved_deps
-        if package in unsolved_deps:
-            error = 'circular dependency for ' + package.category + '/' + \
-              package.name + '-' + package.version
-            raise DependencyError(error)
-        unsolved_deps.add(package)
-        found = True
-        try:
-            desc = package_db.get_package_description(package)
-        except KeyError:
-            found = False
-        if not found:
-            error = "package " + package.category + '/' + \
-                package.name + '-' + package.version + " not found"
-            self.logger.error(error)
-            # at the moment ignore unsolved dependencies, as those deps can be in other repo
-            # or can be external: portage will catch it
-            unsolved_deps.remove(package)
-            return (solved_deps, unsolved_deps)
-
-        dependencies = desc["dependencies"]
-        for pkg in dependencies:
+
+        versions_cache = {}
+
+        def list_versions(category, name):
+            key = (category, name)
+            if key not in versions_cache:
+                try:
+                    versions_cache[key] = \
+                        package_db.list_package_versions(category, name)
+                except InvalidKeyError:
+                    # ignore non existing packages
+                    versions_cache[key] = []
+            return versions_cache[key]
+
+        def get_description(pkg):
             try:
-                versions = package_db.list_package_versions(pkg.category,
-                                                        pkg.package)
-                for version in versions:
-                    solved_deps, unsolved_deps = self.solve_dependencies(package_db,
-                                    Package(pkg.category, pkg.package, version),
-                                    solved_deps, unsolved_deps)
-            except InvalidKeyError:
-                # ignore non existing packages
-                continue
+                return self._get_package_description(package_db, pkg)
+            except KeyError:
+                return None
+
+        def children(desc):
+            for dep in desc["dependencies"]:
+                for version in list_versions(dep.category, dep.package):
+                    yield Package(dep.category, dep.package, version)
 
-        solved_deps.add(package)
-        unsolved_deps.remove(package)
+        stack = []
+
+        def push(pkg):
+            if pkg in solved_deps:
+                return
+            if pkg in unsolved_deps:
+                error = 'circular dependency for ' + pkg.category + '/' + \
+                  pkg.name + '-' + pkg.version
+                raise DependencyError(error)
+            desc = get_description(pkg)
+            if desc is None:
+                error = "package " + pkg.category + '/' + \
+                    pkg.name + '-' + pkg.version + " not found"
+                self.logger.error(error)
+                # at the moment ignore unsolved dependencies, as those deps can be in other repo
+                # or can be external: portage will catch it
+                return
+            unsolved_deps.add(pkg)
+            stack.append((pkg, children(desc)))
+
+        push(package)
+        while stack:
+            pkg, pending = stack[-1]
+            for child in pending:
+                push(child)
+                break
+            else:
+                stack.pop()
+                unsolved_deps.remove(pkg)
+                solved_deps.add(pkg)
 
         return (solved_deps, unsolved_deps)
 
@@ -443,8 +839,15 @@ class Backend(object):
         """
         Digest an overlay using pkgdev or ebuild.
 
+        Given packages are digested with pkgdev one category at a time. If
+        that fails and erase is set, every package of the category is
+        digested again with ebuild, and only those failing there are erased.
+
         Args:
             overlay: Overlay directory.
+            pkgnames: List of full package names (category/package),
+        the whole overlay is digested if None.
+            erase: Whether packages failing to digest should be erased.
         """
         self.logger.info("digesting overlay")
         overlay_path = pathlib.Path(overlay)
@@ -456,38 +859,118 @@ class Backend(object):
                 # FIXME implement erase semantics
                 raise DigestError('pkgdev manifest failed') from e
         else:
-            env = os.environ.copy()
-            env['FEATURES'] = 'assume-digests'
+            by_category = collections.defaultdict(list)
             for pkg in sorted(pkgnames):
-                pkg_path = overlay_path / pkg
-                try:
-                    ebuild = next(pkg_path.glob('*.ebuild'))
-                except StopIteration:
+                if next((overlay_path / pkg).glob('*.ebuild'), None) is None:
                     raise ValueError(f'No ebuild for {pkg}')
+                category, name = pkg.split('/', 1)
+                by_category[category].append(name)
+            for category, names in by_category.items():
                 try:
-                    subprocess.run(['ebuild', ebuild.name, 'manifest'],
-                                   check=True, cwd=pkg_path, env=env)
+                    subprocess.run(['pkgdev', 'manifest'] + names,
+                                   check=True, cwd=overlay_path / category)
                 except subprocess.CalledProcessError as e:
-                    if erase:
-                        shutil.rmtree(pkg_path)
-                        self.logger.warn(
-                            f"Erasing {pkg} due to manifest failure.")
-                    else:
-                        raise DigestError('ebuild manifest failed') from e
+                    if not erase:
+                        raise DigestError('pkgdev manifest failed') from e
+                    # Find out which packages failed and erase them,
+                    # pkgdev does not tell which ones it was
+                    self.logger.warn(
+                        f"pkgdev manifest failed for {category}, digesting"
+                        f" its {len(names)} packages with ebuild instead.")
+                    self._digest_each(overlay,
+                                      [f'{category}/{name}' for name in names],
+                                      erase=erase)
+
+    def _digest_each(self, overlay, pkgnames, erase=False):
+        """
+        Digest packages one by one using ebuild.
+
+        Args:
+            overlay: Overlay directory.
+            pkgnames: List of full package names (category/package).
+            erase: Whether packages failing to digest should be erased.
+        """
+        overlay_path = pathlib.Path(overlay)
+        env = os.environ.copy()
+        env['FEATURES'] = 'assume-digests'
+        for pkg in sorted(pkgnames):
+            pkg_path = overlay_path / pkg
+            try:
+                ebuild = next(pkg_path.glob('*.ebuild'))
+            except StopIteration:
+                raise ValueError(f'No ebuild for {pkg}')
+            try:
+                subprocess.run(['ebuild', ebuild.name, 'manifest'],
+                               check=True, cwd=pkg_path, env=env)
+            except subprocess.CalledProcessError as e:
+                if erase:
+                    shutil.rmtree(pkg_path)
+                    self.logger.warn(
+                        f"Erasing {pkg} due to manifest failure.")
+                else:
+                    raise DigestError('ebuild manifest failed') from e
 
-    def fast_digest(self, overlay, pkgnames):
+    def fast_digest(self, overlay, pkgnames, hashes=MANIFEST_HASHES):
         """
         Digest an overlay using custom method faster than pkgdev.
 
         Args:
             overlay: Overlay directory.
             pkgnames: List of full package names (category/package).
+            hashes: Names of manifest hashes to use.
         """
         self.logger.info("fast digesting overlay")
-        for pkgname in sorted(pkgnames):
+
+        def digest(pkgname):
             directory = pathlib.Path(overlay) / pkgname
             if directory.exists():
-                fast_manifest(directory)
+                # packages are digested in parallel already
+                fast_manifest(directory, hashes, parallel=False)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            for _ in executor.map(digest, sorted(pkgnames)):
+                pass
+
+    @functools.cached_property
+    def _repositories(self):
+        """
+        Repositories available on the system by name.
+        """
+        return {repo.name: repo for repo in portage.settings.repositories}
+
+    def _write_layout(self, overlay_path, masters):
+        """
+        Write metadata/layout.conf of an overlay.
+
+        Args:
+            overlay_path: Overlay directory (pathlib.Path).
+            masters: List of master repositories, gentoo is always added
+        as the last one.
+
+        Returns:
+            False if a master repository is not available, True otherwise.
+        """
+        masters_overlays = []
+        for repo_name in masters:
+            if repo_name != "gentoo":
+                if repo_name not in self._repositories:
+                    self.logger.error(
+                        f"Master repository {repo_name} not available on"
+                        " your system")
+                    self.logger.error(
+                        "Please, add it (either via layman or eselect"
+                        " repository)")
+                    return False
+                masters_overlays.append(repo_name)
+        masters_overlays.append("gentoo")
+
+        metadata_path = overlay_path / 'metadata'
+        metadata_path.mkdir(exist_ok=True, parents=True)
+        with open(metadata_path / 'layout.conf', 'w') as f:
+            f.write(f"repo-name = {overlay_path.name}\n")
+            f.write("masters = " + " ".join(masters_overlays) + "\n")
+        return True
 
     def generate_tree(self, args, config, global_config):
         """
@@ -509,93 +992,76 @@ class Backend(object):
 
         self.logger.info("tree generation")
         overlay = self._get_overlay(args, config, global_config)
-        pkg_db = self._get_package_db(args, config, global_config)
+        pkg_db = self._get_package_db(args, config, global_config,
+                                      overlay=overlay)
         pkg_db.read()
 
-        os.system('rm -rf ' + overlay + '/*')
+        # Hidden entries (like the g-sorcery database) are preserved.
+        overlay_path = pathlib.Path(overlay)
+        if overlay_path.is_dir():
+            entries = [entry for entry in overlay_path.iterdir()
+                       if not entry.name.startswith('.')]
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=16) as executor:
+                for _ in executor.map(_remove_path, entries):
+                    pass
         os.makedirs(os.path.join(overlay, 'profiles'))
-        os.system("echo " + os.path.basename(overlay) + '>'
-                  + os.path.join(overlay, 'profiles', 'repo_name'))
+        with open(os.path.join(overlay, 'profiles', 'repo_name'), 'w') as f:
+            f.write(os.path.basename(overlay) + '\n')
 
-        os.makedirs(os.path.join(overlay, 'metadata'))
-        if "masters" not in config["repositories"][args.repository]:
-            masters = elist(["gentoo"])
-        else:
-            masters = elist(config["repositories"][args.repository]["masters"])
-
-        masters_overlays = elist()
-        repositories = {repo.name: repo
-                        for repo in portage.settings.repositories}
-
-        for repo_name in masters:
-            if repo_name != "gentoo":
-                if repo_name not in repositories:
-                    self.logger.error("Master repository " + repo_name
-                                      + " not available on your system")
-                    self.logger.error("Please, add it with layman -a "
-                                      + repo_name)
-                    return -1
-                masters_overlays.append(repo_name)
-        masters_overlays.append("gentoo")
-
-        with open(os.path.join(overlay, 'metadata', 'layout.conf'), 'w') as f:
-            f.write("repo-name = %s\n" % os.path.basename(overlay))
-            f.write("masters = %s\n" % masters_overlays)
+        masters = config["repositories"][args.repository].get("masters", [])
+        if not self._write_layout(overlay_path, masters):
+            return -1
 
         if args.digest:
-            ebuild_g = self.ebuild_g_with_digest_class(pkg_db)
+            ebuild_g = self._get_generator(self.ebuild_g_with_digest_class,
+                                           pkg_db)
         else:
-            ebuild_g = self.ebuild_g_without_digest_class(pkg_db)
-        metadata_g = self.metadata_g_class(pkg_db)
+            ebuild_g = self._get_generator(
+                self.ebuild_g_without_digest_class, pkg_db)
+        metadata_g = self._get_generator(self.metadata_g_class, pkg_db)
 
-        packages_iter = pkg_db
-        catpkg_names = pkg_db.list_catpkg_names()
         if packages:
             dependencies = set()
-            catpkg_names = set()
-            packages_dict = {}
             for pkg in packages:
-                dependencies |= self.get_dependencies(pkg_db, pkg)
-
-            for pkg in dependencies:
-                catpkg_names |= set([pkg.category + '/' + pkg.name])
-                packages_dict[pkg] = pkg_db.get_package_description(pkg)
-            packages_iter = packages_dict.items()
-
-        for package, ebuild_data in packages_iter:
-            category = package.category
-            name = package.name
-            version = package.version
-            self.logger.info("    generating " +
-                             category + '/' + name + '-' + version)
-            path = os.path.join(overlay, category, name)
-            if not os.path.exists(path):
-                os.makedirs(path)
-            source = ebuild_g.generate(package, ebuild_data)
-            with open(os.path.join(path,
-                                   name + '-' + version + '.ebuild'),
-                      'wb') as f:
-                f.write('\n'.join(source).encode('utf-8'))
-
-            source = metadata_g.generate(package)
-            with open(os.path.join(path, 'metadata.xml'), 'wb') as f:
-                f.write('\n'.join(source).encode('utf-8'))
-
-        eclass_g = self.eclass_g_class()
+                self.get_dependencies(pkg_db, pkg, dependencies)
+            catpkg_names = {pkg.category + '/' + pkg.name
+                            for pkg in dependencies}
+        else:
+            dependencies = pkg_db.list_all_packages()
+            catpkg_names = pkg_db.list_catpkg_names()
+
+        rendered = self._render(dependencies, ebuild_g, metadata_g)
+        with _file_writer() as write, LogBuffer(self.logger) as log:
+            for package, ebuild, metadata in rendered:
+                category = package.category
+                name = package.name
+                version = package.version
+                log.info("    generating " +
+                         category + '/' + name + '-' + version)
+                path = os.path.join(overlay, category, name)
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                write(os.path.join(path, name + '-' + version + '.ebuild'),
+                      ebuild)
+                write(os.path.join(path, 'metadata.xml'), metadata)
+
+        eclass_g = self._eclass_g
         path = os.path.join(overlay, 'eclass')
         if not os.path.exists(path):
             os.makedirs(path)
 
         for eclass in eclass_g.list():
             source = eclass_g.generate(eclass)
-            with open(os.path.join(path, eclass + '.eclass'), 'w') as f:
-                f.write('\n'.join(source))
+            _write_lines(os.path.join(path, eclass + '.eclass'), source)
 
+        hashes = config["repositories"][args.repository].get(
+            "manifest_hashes", MANIFEST_HASHES)
         if args.digest:
             self.digest(overlay, erase=args.erase)
         else:
             pkgnames = catpkg_names
-            self.fast_digest(overlay, pkgnames)
+            self.fast_digest(overlay, pkgnames, hashes)
 
         try:
             clean_db = config["repositories"][args.repository]["clean_db"]
@@ -625,7 +1091,8 @@ class Backend(object):
         self.logger.info("tree update")
         overlay = self._get_overlay(args, config, global_config)
         overlay_path = pathlib.Path(overlay)
-        pkg_db = self._get_package_db(args, config, global_config)
+        pkg_db = self._get_package_db(args, config, global_config,
+                                      overlay=overlay)
         pkg_db.read()
 
         profiles_path = overlay_path / 'profiles'
@@ -633,117 +1100,103 @@ class Backend(object):
         with open(profiles_path / 'repo_name', 'w') as f:
             f.write(overlay_path.name)
 
-        metadata_path = overlay_path / 'metadata'
-        metadata_path.mkdir(exist_ok=True, parents=True)
-        if "masters" not in config["repositories"][args.repository]:
-            masters = elist(["gentoo"])
-        else:
-            masters = elist(config["repositories"][args.repository]["masters"])
-
-        masters_overlays = elist()
-        repositories = {repo.name: repo
-                        for repo in portage.settings.repositories}
-        for repo_name in masters:
-            if repo_name != "gentoo":
-                if repo_name not in repositories:
-                    self.logger.error(
-                        f"Master repository {repo_name} not available on"
-                        " your system")
-                    self.logger.error(
-                        "Please, add it (either via layman or eselect"
-                        " repository)")
-                    return -1
-                masters_overlays.append(repo_name)
-        masters_overlays.append("gentoo")
-
-        with open(metadata_path / 'layout.conf', 'w') as f:
-            f.write(f"repo-name = {overlay_path.name}\n")
-            f.write(f"masters = {masters_overlays}\n")
+        masters = config["repositories"][args.repository].get("masters", [])
+        if not self._write_layout(overlay_path, masters):
+            return -1
 
         if args.digest:
-            ebuild_g = self.ebuild_g_with_digest_class(pkg_db)
+            ebuild_g = self._get_generator(self.ebuild_g_with_digest_class,
+                                           pkg_db)
         else:
-            ebuild_g = self.ebuild_g_without_digest_class(pkg_db)
-        metadata_g = self.metadata_g_class(pkg_db)
+            ebuild_g = self._get_generator(
+                self.ebuild_g_without_digest_class, pkg_db)
+        metadata_g = self._get_generator(self.metadata_g_class, pkg_db)
 
-        packages_iter = pkg_db
-        catpkg_names = pkg_db.list_catpkg_names()
         if packages:
             dependencies = set()
-            catpkg_names = set()
-            packages_dict = {}
             for pkg in packages:
-                dependencies |= self.get_dependencies(pkg_db, pkg)
-
-            for pkg in dependencies:
-                catpkg_names |= set([f'{pkg.category}/{pkg.name}'])
-                packages_dict[pkg] = pkg_db.get_package_description(pkg)
-            packages_iter = packages_dict.items()
+                self.get_dependencies(pkg_db, pkg, dependencies)
+            catpkg_names = {f'{pkg.category}/{pkg.name}'
+                            for pkg in dependencies}
+            dependencies = sorted(dependencies,
+                                  key=lambda pkg: (pkg.category, pkg.name))
+        else:
+            # Already grouped by package
+            dependencies = pkg_db.list_all_packages()
+            catpkg_names = pkg_db.list_catpkg_names()
 
         generated = []
         kept = []
-        new = set()
-        total = set()
-        for package, ebuild_data in packages_iter:
-            category = package.category
-            name = package.name
-            version = package.version
-            path = overlay_path / category / name
-            path.mkdir(parents=True, exist_ok=True)
-            source = ebuild_g.generate(package, ebuild_data)
-            ebuild_path = path / f'{name}-{version}.ebuild'
-            preexists = ebuild_path.exists()
-            with open(ebuild_path, 'wb') as f:
-                f.write('\n'.join(source).encode('utf-8'))
-            new.add(ebuild_path)
-            for other in path.glob(f'{name}-*.ebuild'):
-                total.add(other)
-
-            # If multiple vorsions of the same package a generated this
-            # clobbers the metadata.xml. However no apparently better option
-            # presents itself.
-            source = metadata_g.generate(package)
-            with open(path / 'metadata.xml', 'wb') as f:
-                f.write('\n'.join(source).encode('utf-8'))
-
-            if not preexists:
-                self.logger.info(f"    generated {category}/{name}-{version}")
-                generated.append(package)
-            else:
-                self.logger.info(f"    refreshed {category}/{name}-{version}")
-                kept.append(package)
-
-        # First clean untouched ebuilds in updated packages
-        for stale in total - new:
-            self.logger.info(f"    scrub {stale}")
-            stale.unlink()
-
-        # Second clean packages which were not updated
+        rendered = self._render(dependencies, ebuild_g, metadata_g)
+        with _file_writer() as write, LogBuffer(self.logger) as log:
+            for (category, name), group in itertools.groupby(
+                    rendered, key=lambda item: (item[0].category,
+                                                item[0].name)):
+                path = overlay_path / category / name
+                path.mkdir(parents=True, exist_ok=True)
+                ebuilds = set()
+                for package, ebuild, metadata in group:
+                    version = package.version
+                    ebuild_name = f'{name}-{version}.ebuild'
+                    ebuild_path = path / ebuild_name
+                    preexists = ebuild_path.exists()
+                    write(ebuild_path, ebuild)
+                    ebuilds.add(ebuild_name)
+
+                    # If multiple vorsions of the same package a generated
+                    # this clobbers the metadata.xml. However no apparently
+                    # better option presents itself.
+                    write(path / 'metadata.xml', metadata)
+
+                    if not preexists:
+                        log.info(f"    generated {category}/{name}-{version}")
+                        generated.append(package)
+                    else:
+                        log.info(f"    refreshed {category}/{name}-{version}")
+                        kept.append(package)
+
+                # Clean untouched ebuilds of the updated package
+                prefix = f'{name}-'
+                suffix = '.ebuild'
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        entry_name = entry.name
+                        if entry_name not in ebuilds \
+                           and entry_name.startswith(prefix) \
+                           and entry_name.endswith(suffix):
+                            log.info(f"    scrub {entry.path}")
+                            os.unlink(entry.path)
+
+        # Clean packages which were not updated
         protected = {'eclass', 'profiles', 'metadata'}
         seen = {f'{pkg.category}/{pkg.name}'
                 for pkg in itertools.chain(generated, kept)}
-        for category in overlay_path.iterdir():
-            if category.name.startswith('.') or category.name in protected:
-                continue
-            if category.is_dir():
-                for package in category.iterdir():
-                    qualified = f'{category.name}/{package.name}'
-                    if package.is_dir() and qualified not in seen:
-                        if not args.keep:
-                            self.logger.info(f"    cleaning {qualified}")
-                            shutil.rmtree(package)
-                        else:
-                            self.logger.info(f"    keeping {qualified}")
-
-        eclass_g = self.eclass_g_class()
+        with os.scandir(overlay) as categories:
+            for category in categories:
+                if category.name.startswith('.') \
+                   or category.name in protected or not category.is_dir():
+                    continue
+                with os.scandir(category.path) as packages:
+                    for package in packages:
+                        qualified = f'{category.name}/{package.name}'
+                        if package.is_dir() and qualified not in seen:
+                            if not args.keep:
+                                self.logger.info(
+                                    f"    cleaning {qualified}")
+                                shutil.rmtree(package.path)
+                            else:
+                                self.logger.info(f"    keeping {qualified}")
+
+        eclass_g = self._eclass_g
         path = overlay_path / 'eclass'
         path.mkdir(exist_ok=True)
 
         for eclass in eclass_g.list():
             source = eclass_g.generate(eclass)
-            with open(path / f'{eclass}.eclass', 'w') as f:
-                f.write('\n'.join(source))
+            _write_lines(path / f'{eclass}.eclass', source)
 
+        hashes = config["repositories"][args.repository].get(
+            "manifest_hashes", MANIFEST_HASHES)
         if args.digest:
             generated_pkgnames = {f'{pkg.category}/{pkg.name}'
                                   for pkg in generated}
@@ -752,10 +1205,10 @@ class Backend(object):
             kept_pkgnames = {f'{pkg.category}/{pkg.name}' for pkg in kept}
             todo_pkgnames = kept_pkgnames - generated_pkgnames
             self.logger.info(f"Fast digesting {len(todo_pkgnames)} packages.")
-            self.fast_digest(overlay, todo_pkgnames)
+            self.fast_digest(overlay, todo_pkgnames, hashes)
         else:
             pkgnames = catpkg_names
-            self.fast_digest(overlay, pkgnames)
+            self.fast_digest(overlay, pkgnames, hashes)
 
         try:
             clean_db = config["repositories"][args.repository]["clean_db"]
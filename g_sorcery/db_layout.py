@@ -142,13 +142,12 @@ class Metadata(FileJSON):
         If file doesn't exist, we have a legacy DB
         with DB layout v. 0. Fill metadata appropriately.
         """
-        if not os.path.exists(self.directory):
-            os.makedirs(self.directory)
-        content = {}
-        if not os.path.isfile(self.path):
+        try:
+            content = self.read_content()
+        except FileNotFoundError:
+            os.makedirs(self.directory, exist_ok=True)
             content = {'db_version': 0, 'layout_version': 0, 'category_format': JSON_FILE_SUFFIX}
         else:
-            content = self.read_content()
             for key in self.mandatories:
                 if not key in content:
                     raise FileJSONError('lack of mandatory key: ' + key)
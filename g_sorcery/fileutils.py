@@ -11,17 +11,29 @@
     :license: GPL-2, see LICENSE for more details.
 """
 
-import glob
+import concurrent.futures
 import json
+import lzma
 import hashlib
+import http.client
+import mmap
 import os
 import pathlib
-import subprocess
+import shutil
 import tarfile
+import urllib.parse
+import urllib.request
 
 from .compatibility import TemporaryDirectory
 from .exceptions import FileJSONError, DownloadingError
-from .serialization import JSONSerializer, deserializeHook
+from .serialization import JSONSerializer, deserializeHook, \
+     from_raw_serializable, step_to_raw_serializable
+
+# orjson is optional, the standard json module is used if it is missing
+try:
+    import orjson
+except ImportError as e:
+    orjson = None
 
 class FileJSONData(object):
     """
@@ -46,15 +58,15 @@ class FileJSONData(object):
         """
         Read file.
         """
-        if not os.path.exists(self.directory):
-            os.makedirs(self.directory)
-        content = {}
-        if not os.path.isfile(self.path):
+        try:
+            content = self.read_content()
+        except FileNotFoundError:
+            content = {}
             for key in self.mandatories:
                 content[key] = ""
+            os.makedirs(self.directory, exist_ok=True)
             self.write_content(content)
         else:
-            content = self.read_content()
             for key in self.mandatories:
                 if not key in content:
                     raise FileJSONError('lack of mandatory key: ' + key)
@@ -74,8 +86,7 @@ class FileJSONData(object):
         for key in self.mandatories:
             if not key in content:
                 raise FileJSONError('lack of mandatory key: ' + key)
-        if not os.path.exists(self.directory):
-            os.makedirs(self.directory)
+        os.makedirs(self.directory, exist_ok=True)
         self.write_content(content)
 
     def write_content(self, content):
@@ -96,16 +107,39 @@ class FileJSON(FileJSONData):
         Read JSON file.
         """
         content = {}
-        with open(self.path, 'r') as f:
-            content = json.load(f, object_hook=deserializeHook)
+        if orjson:
+            with open(self.path, 'rb') as f:
+                content = from_raw_serializable(orjson.loads(f.read()))
+        else:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                content = json.load(f, object_hook=deserializeHook)
         return content
 
     def write_content(self, content):
         """
         Write JSON file.
         """
-        with open(self.path, 'w') as f:
-            json.dump(content, f, indent=2, sort_keys=True, cls=JSONSerializer)
+        if orjson:
+            data = orjson.dumps(content, default=_orjson_default,
+                                option=orjson.OPT_INDENT_2
+                                | orjson.OPT_SORT_KEYS
+                                | orjson.OPT_NON_STR_KEYS)
+            with open(self.path, 'wb') as f:
+                f.write(data)
+        else:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(content, f, indent=2, sort_keys=True,
+                          cls=JSONSerializer)
+
+
+def _orjson_default(obj):
+    """
+    Serialize objects orjson does not know about, see JSONSerializer.
+    """
+    res = step_to_raw_serializable(obj)
+    if res:
+        return res
+    raise TypeError('Non serializable object: ', obj)
 
 
 def hash_file(name, hasher, blocksize=65536):
@@ -135,7 +169,16 @@ def copy_all(src, dst):
        src: Source.
        dst: Destination.
     """
-    os.system("cp -rv " + src + "/* " + dst)
+    # like "cp -r src/* dst", hidden entries (e.g. .git) are not copied
+    with os.scandir(src) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir():
+                shutil.copytree(entry.path, target, dirs_exist_ok=True)
+            else:
+                shutil.copy2(entry.path, target)
 
 def wget(uri, directory, output="", timeout=None):
     """
@@ -150,18 +193,32 @@ def wget(uri, directory, output="", timeout=None):
     Returns:
         Nonzero in case of a failure.
     """
-    cmd = ['wget', '-U', 'wget for g-sorcery']
-    if output:
-        cmd.extend(['-O', os.path.join(directory, output)])
-    else:
-        cmd.extend(['-P', directory])
-    if timeout:
-        cmd.extend(['-T', str(timeout)])
-    cmd.append(uri)
-
-    ret = subprocess.run(cmd, stdout=subprocess.DEVNULL,
-                         stderr=subprocess.DEVNULL)
-    return ret.returncode
+    # wget assumes http for URIs without a scheme; urlsplit alone is not
+    # enough, as it takes the host of "localhost:8080/file" for a scheme
+    if not urllib.parse.urlsplit(uri).scheme or '://' not in uri:
+        uri = 'http://' + uri
+    if not output:
+        # name the file after the URI, as wget does
+        path = urllib.parse.unquote(urllib.parse.urlsplit(uri).path)
+        output = os.path.basename(path) or 'index.html'
+    path = os.path.join(directory, output)
+    try:
+        request = urllib.request.Request(
+            uri, headers={'User-Agent': 'wget for g-sorcery'})
+        with urllib.request.urlopen(request, timeout=timeout) as response, \
+             open(path, 'wb') as f:
+            shutil.copyfileobj(response, f, 1 << 20)
+            # sized reads return short data when the connection drops
+            missing = getattr(response, 'length', None)
+            if missing:
+                raise http.client.IncompleteRead(b'', missing)
+    except (OSError, ValueError, http.client.HTTPException):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return 1
+    return 0
 
 def get_pkgpath(root = None):
     """
@@ -179,6 +236,13 @@ def get_pkgpath(root = None):
         root = os.path.realpath(root)
     return os.path.dirname(os.path.abspath(root))
 
+# Supported manifest hashes and the default selection (as in ::gentoo).
+MANIFEST_HASHERS = {'BLAKE2B': hashlib.blake2b, 'SHA512': hashlib.sha512}
+MANIFEST_HASHES = ('BLAKE2B', 'SHA512')
+
+# Files larger than this are memory mapped when digested.
+_MMAP_THRESHOLD = 4 << 20
+
 class ManifestEntry(object):
     """
     A manifest entry for a file.
@@ -187,62 +251,127 @@ class ManifestEntry(object):
     __slots__ = ('directory', 'name', 'ftype',
                  'size', 'sha512', 'blake2b')
 
-    def __init__(self, directory, name, ftype):
+    def __init__(self, directory, name, ftype, hashes=MANIFEST_HASHES):
         self.directory = directory
         self.name = name
         self.ftype = ftype
-        self.digest()
+        self.digest(hashes)
 
-    def digest(self):
+    def digest(self, hashes=MANIFEST_HASHES):
         """
         Digest a file associated with a manifest entry.
+
+        Args:
+            hashes: Names of manifest hashes to compute, hashes not
+        computed are set to None.
         """
-        h_sha512 = hashlib.new('SHA512')
-        h_blake2b = hashlib.new('blake2b')
+        hashers = [MANIFEST_HASHERS[name]() for name in hashes]
         with open(os.path.join(self.directory, self.name), 'rb') as f:
-            src = f.read()
-        h_sha512.update(src)
-        h_blake2b.update(src)
-        self.size = str(len(src))
-        self.sha512 = h_sha512.hexdigest()
-        self.blake2b = h_blake2b.hexdigest()
-
-
-def fast_manifest(directory):
+            size = os.fstat(f.fileno()).st_size
+            if size > _MMAP_THRESHOLD:
+                # hash the mapped pages directly, without copying them
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as view:
+                        for hasher in hashers:
+                            hasher.update(view)
+                    size = len(mm)
+            else:
+                size = 0
+                while chunk := f.read(1 << 20):
+                    for hasher in hashers:
+                        hasher.update(chunk)
+                    size += len(chunk)
+        self.size = str(size)
+        self.sha512 = None
+        self.blake2b = None
+        for name, hasher in zip(hashes, hashers):
+            setattr(self, name.lower(), hasher.hexdigest())
+
+
+def fast_manifest(directory, hashes=MANIFEST_HASHES, parallel=True):
     """
     Digest package directory.
     This function is intended to be used in place of pkgdev manifest,
-    as it is to slow.
+    as it is to slow. Hashes of files that have not changed since
+    the existing Manifest was written are reused.
 
     Args:
         directory: Directory.
+        hashes: Names of manifest hashes to use.
+        parallel: Whether files should be digested in parallel threads.
     """
     directory_path = pathlib.Path(directory)
-    manifest = []
+    entries = []
 
     files_path = directory_path / 'files'
     for aux in files_path.glob('*'):
-        manifest.append(ManifestEntry(aux.parent, aux.name, "AUX"))
+        entries.append((aux.parent, aux.name, "AUX"))
     for ebuild in directory_path.glob("*.ebuild"):
-        manifest.append(ManifestEntry(directory, ebuild.name, "EBUILD"))
+        entries.append((directory, ebuild.name, "EBUILD"))
     metadata = directory_path / "metadata.xml"
     if metadata.is_file():
-        manifest.append(ManifestEntry(directory, "metadata.xml", "MISC"))
-
-    manifest = [" ".join([m.ftype, m.name, m.size,
-                          "BLAKE2B", m.blake2b, "SHA512", m.sha512])
-                for m in manifest]
+        entries.append((directory, "metadata.xml", "MISC"))
 
     manifest_path = directory_path / "Manifest"
-    if manifest_path.is_file():
-        with open(manifest_path, 'r') as f:
-            for line in f.read().splitlines():
-                if line.startswith('DIST'):
-                    manifest.append(line)
+    dist = []
+    known = {}
+    try:
+        with open(manifest_path, 'rb') as f:
+            manifest_mtime = os.fstat(f.fileno()).st_mtime_ns
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        lines = None
+    else:
+        for line in lines:
+            if line.startswith(b'DIST'):
+                dist.append(line)
+            elif line.startswith((b'AUX ', b'EBUILD ', b'MISC ')):
+                # other lines (e.g. of a clearsigned Manifest) are ignored
+                fields = line.decode().split(' ')
+                if len(fields) >= 3:
+                    known[(fields[0], fields[1])] = \
+                        (fields[2], dict(zip(fields[3::2], fields[4::2])))
+
+    def digest(entry):
+        directory, name, ftype = entry
+        # files not modified since the Manifest was written keep their hashes
+        previous = known.get((ftype, name))
+        if previous:
+            stat = os.stat(os.path.join(directory, name))
+            size, digests = previous
+            if stat.st_mtime_ns < manifest_mtime \
+               and str(stat.st_size) == size \
+               and all(hash_name in digests for hash_name in hashes):
+                return size, digests
+        m = ManifestEntry(directory, name, ftype, hashes=hashes)
+        return m.size, {hash_name: getattr(m, hash_name.lower())
+                        for hash_name in hashes}
+
+    if parallel and len(entries) > 1:
+        # hashlib releases the GIL, so files are digested in parallel;
+        # the pool does not outlive the call, so no threads are left
+        # behind when worker processes are forked later
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(entries), os.cpu_count() or 1)) \
+                as executor:
+            digested = list(executor.map(digest, entries))
+    else:
+        digested = map(digest, entries)
+
+    # lines are kept as bytes, so sorting compares them with memcmp
+    ordered = sorted(hashes)
+    manifest = [" ".join([ftype, name, size] +
+                         [field for hash_name in ordered
+                          for field in (hash_name, digests[hash_name])]
+                         ).encode()
+                for (_, name, ftype), (size, digests) in zip(entries, digested)]
+
+    if lines is not None:
+        manifest.extend(dist)
         manifest.sort()
 
-    with open(manifest_path, 'w') as f:
-        f.write('\n'.join(manifest) + '\n')
+    with open(manifest_path, 'wb') as f:
+        f.write(b'\n'.join(manifest) + b'\n')
 
 
 def _call_parser(f_name, parser, open_file = True, open_mode = 'r'):
@@ -268,6 +397,47 @@ def _call_parser(f_name, parser, open_file = True, open_mode = 'r'):
     return {os.path.basename(f_name): data}
 
 
+# gzip, bzip2 and xz signatures
+_COMPRESSION_MAGICS = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00')
+
+def _open_tar(f):
+    """
+    Open a tar archive (possibly compressed) from a file object.
+
+    Args:
+        f: File object opened in binary mode.
+
+    Returns:
+        tarfile.TarFile instance or None if it is not a tar archive.
+    """
+    # only try tarfile on things that look like an archive
+    header = f.read(512)
+    f.seek(0)
+    if not header.startswith(_COMPRESSION_MAGICS) \
+       and header[257:262] != b'ustar':
+        return None
+    try:
+        return tarfile.open(fileobj=f)
+    except tarfile.TarError:
+        f.seek(0)
+        return None
+
+
+def _list_dir(directory):
+    """
+    List non-hidden entries of a directory.
+
+    Args:
+        directory: Directory.
+
+    Returns:
+        List of paths.
+    """
+    with os.scandir(directory) as entries:
+        return [entry.path for entry in entries
+                if not entry.name.startswith('.')]
+
+
 def load_remote_file(uri, parser, open_file = True, open_mode = 'r', output = "", timeout = None):
     """
     Load files from an URI.
@@ -288,21 +458,34 @@ def load_remote_file(uri, parser, open_file = True, open_mode = 'r', output = ""
     loaded_data = {}
     if wget(uri, download_dir.name, output, timeout=timeout):
         raise DownloadingError("wget failed: " + uri)
-    for f_name in glob.glob(os.path.join(download_dir.name, "*")):
-        if tarfile.is_tarfile(f_name):
-            unpack_dir = TemporaryDirectory()
-            with tarfile.open(f_name) as f:
-                f.extractall(unpack_dir.name)
-            for uf_name in glob.glob(os.path.join(unpack_dir, "*")):
+    for f_name in _list_dir(download_dir.name):
+        with open(f_name, 'rb') as f:
+            tar = _open_tar(f)
+            if tar:
+                unpack_dir = TemporaryDirectory()
+                with tar:
+                    tar.extractall(unpack_dir.name)
+        if tar:
+            for uf_name in _list_dir(unpack_dir.name):
                 loaded_data.update(_call_parser(uf_name, parser,
                                     open_file=open_file, open_mode=open_mode))
             del unpack_dir
         else:
             name, extention = os.path.splitext(f_name)
             if extention in [".xz", ".lzma"]:
-                if (os.system("xz -d " + f_name)):
+                try:
+                    if open_file:
+                        # parse the decompressed stream directly
+                        mode = open_mode if 'b' in open_mode else 'rt'
+                        with lzma.open(f_name, mode) as f:
+                            loaded_data[os.path.basename(name)] = parser(f)
+                        continue
+                    with lzma.open(f_name) as src, open(name, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+                except (lzma.LZMAError, EOFError):
                     raise DownloadingError("xz failed: "
                                 + f_name + " from " + uri)
+                os.remove(f_name)
                 f_name = name
             loaded_data.update(_call_parser(f_name, parser,
                                 open_file=open_file, open_mode=open_mode))
@@ -21,6 +21,14 @@ import re
 import portage
 
 
+# serialized forms of Dependency and Version
+_DEP_RE = re.compile(r'(?:([A-Za-z0-9+_@-]+)\?)?\s*'
+                     r'\(?\s*([=<>!~A-Za-z0-9+_./-]*)(?:\[(.*)\])?\s*\)?')
+_VER_RE = re.compile(
+    r'([0-9\.]+)([a-z])?(?:_alpha([0-9]+))?(?:_beta([0-9]+))?'
+    r'(?:_pre([0-9]+))?(?:_rc([0-9]+))?(?:_p([0-9]+))?(?:-r([0-9]+))?')
+
+
 class elist(list):
     '''Custom list type which adds a customized __str__()
     and takes an optional separator argument
@@ -47,7 +55,11 @@ class elist(list):
         '''Custom output function
         'x.__str__() <==> str(separator.join(x))'
         '''
-        return self._sep_.join(map(str, self))
+        try:
+            # members are usually strings already
+            return self._sep_.join(self)
+        except TypeError:
+            return self._sep_.join(map(str, self))
 
 
 class serializable_elist(object):
@@ -86,6 +98,10 @@ class serializable_elist(object):
 
     @classmethod
     def deserialize(cls, value):
+        # a [separator, data] pair is accepted as well
+        if isinstance(value, list):
+            separator, data = value
+            return serializable_elist(data, separator = separator)
         return serializable_elist(value["data"], separator = value["separator"])
 
 
@@ -94,13 +110,21 @@ class serializable_elist(object):
 class Package(object):
     """
     Class to store full package name: category/package-version
+
+    Instances must not be modified after construction, as the hash
+    is computed in __init__.
     """
-    __slots__ = ('category', 'name', 'version')
+    __slots__ = ('category', 'name', 'version', '_hash')
 
     def __init__(self, category, package, version):
         self.category = category
         self.name = package
         self.version = version
+        self._hash = hash((category, package, version))
+
+    def __reduce__(self):
+        # the cached hash is not valid in another interpreter
+        return (self.__class__, (self.category, self.name, self.version))
 
     def __str__(self):
         return self.category + '/' + self.name + '-' + self.version
@@ -111,7 +135,7 @@ class Package(object):
             self.version == other.version
 
     def __hash__(self):
-        return hash(self.category + self.name + self.version)
+        return self._hash
 
     def serialize(self):
         return [self.category, self.name, self.version]
@@ -121,11 +145,27 @@ class Package(object):
         return Package(*value)
 
 
+@functools.lru_cache(maxsize=1 << 16)
+def _atom(atom_str):
+    """
+    Get a portage Atom, identical atoms are parsed only once.
+
+    Args:
+        atom_str: Atom string.
+
+    Returns:
+        portage.dep.Atom instance (these are immutable, so can be shared).
+    """
+    return portage.dep.Atom(atom_str)
+
+
 #todo equality operator for Dependency, as it can be used in backend dependency solving algorithm
 
 class Dependency(object):
     """
     Class to store a dependency. Uses portage Atom.
+
+    Instances must not be modified after construction.
     """
 
     __slots__ = ('atom', 'formatted', 'category', 'package', 'version',
@@ -144,18 +184,14 @@ class Dependency(object):
             formatted = f'{formatted}[{usedep}]'
         if useflag:
             formatted = f'{useflag}? ( {formatted} )'
-        object.__setattr__(self, "atom", portage.dep.Atom(atom_str))
-        object.__setattr__(self, "formatted", formatted)
-        object.__setattr__(self, "category", category)
-        object.__setattr__(self, "package", package)
-        object.__setattr__(self, "version", version)
-        object.__setattr__(self, "operator", operator)
-        object.__setattr__(self, "usedep", usedep)
-        object.__setattr__(self, "useflag", useflag)
-
-    def __setattr__(self, name, value):
-        raise AttributeError("Dependency instances are immutable",
-                             self.__class__, name, value)
+        self.atom = _atom(atom_str)
+        self.formatted = formatted
+        self.category = category
+        self.package = package
+        self.version = version
+        self.operator = operator
+        self.usedep = usedep
+        self.useflag = useflag
 
     def __str__(self):
         return self.formatted
@@ -165,11 +201,9 @@ class Dependency(object):
 
     @classmethod
     def deserialize(cls, value):
-        mo = re.fullmatch(r'(?:([A-Za-z0-9+_@-]+)\?)?\s*'
-                          r'\(?\s*([=<>!~A-Za-z0-9+_./-]*)(?:\[(.*)\])?\s*\)?',
-                          value)
+        mo = _DEP_RE.fullmatch(value)
         rawuseflag, rawatom, rawusedep = mo.groups()
-        atom = portage.dep.Atom(rawatom)
+        atom = _atom(rawatom)
         operator = portage.dep.get_operator(atom)
         cpv = portage.dep.dep_getcpv(atom)
         category, rest = portage.catsplit(cpv)
@@ -187,43 +221,79 @@ class Dependency(object):
                           useflag)
 
 
+def _version_part(value, sign):
+    """
+    Make an orderable comparison key for an optional version part.
+
+    Args:
+        value: Part value or None if it is absent.
+        sign: -1 if presence of the part sorts before absence
+    (as for _alpha), 1 otherwise (as for _p).
+
+    Returns:
+        Tuple to be compared.
+    """
+    if value is None:
+        return (0,)
+    return (sign, value)
+
+
 @functools.total_ordering
 class Version(object):
     """
     Class to store a version.
+
+    Instances must not be modified after construction,
+    as comparison and hashing use a key computed in __init__.
     """
 
-    __slots__ = ('formatted', 'components', 'suffix', 'alpha', 'beta', 'pre',
-                 'rc', 'p', 'revision')
+    __slots__ = ('_formatted', '_key', 'components', 'suffix', 'alpha',
+                 'beta', 'pre', 'rc', 'p', 'revision')
 
     def __init__(self, components, suffix="", alpha=None, beta=None, pre=None,
                  rc=None, p=None, revision=None):
-        formatted = f'{".".join(map(str, components))}{suffix}'
-        if alpha is not None:
-            formatted = f'{formatted}_alpha{alpha}'
-        if beta is not None:
-            formatted = f'{formatted}_beta{beta}'
-        if pre is not None:
-            formatted = f'{formatted}_pre{pre}'
-        if rc is not None:
-            formatted = f'{formatted}_rc{rc}'
-        if p is not None:
-            formatted = f'{formatted}_p{p}'
-        if revision is not None:
-            formatted = f'{formatted}-r{revision}'
-        object.__setattr__(self, "formatted", formatted)
-        object.__setattr__(self, 'components', components)
-        object.__setattr__(self, 'suffix', suffix)
-        object.__setattr__(self, 'alpha', alpha)
-        object.__setattr__(self, 'beta', beta)
-        object.__setattr__(self, 'pre', pre)
-        object.__setattr__(self, 'rc', rc)
-        object.__setattr__(self, 'p', p)
-        object.__setattr__(self, 'revision', revision)
-
-    def __setattr__(self, name, value):
-        raise AttributeError("Version instances are immutable",
-                             self.__class__, name, value)
+        self.components = components
+        self.suffix = suffix
+        self.alpha = alpha
+        self.beta = beta
+        self.pre = pre
+        self.rc = rc
+        self.p = p
+        self.revision = revision
+        # Treat missing components as zero, so trailing zeros are dropped
+        end = len(components)
+        while end and components[end - 1] == 0:
+            end -= 1
+        self._key = (
+            tuple(components[:end]), suffix,
+            _version_part(alpha, -1), _version_part(beta, -1),
+            _version_part(pre, -1), _version_part(rc, -1),
+            _version_part(p, 1), _version_part(revision, 1))
+
+    @property
+    def formatted(self):
+        """
+        Version string, built on first use.
+        """
+        try:
+            return self._formatted
+        except AttributeError:
+            pass
+        formatted = f'{".".join(map(str, self.components))}{self.suffix}'
+        if self.alpha is not None:
+            formatted = f'{formatted}_alpha{self.alpha}'
+        if self.beta is not None:
+            formatted = f'{formatted}_beta{self.beta}'
+        if self.pre is not None:
+            formatted = f'{formatted}_pre{self.pre}'
+        if self.rc is not None:
+            formatted = f'{formatted}_rc{self.rc}'
+        if self.p is not None:
+            formatted = f'{formatted}_p{self.p}'
+        if self.revision is not None:
+            formatted = f'{formatted}-r{self.revision}'
+        self._formatted = formatted
+        return formatted
 
     def __str__(self):
         return self.formatted
@@ -231,57 +301,22 @@ class Version(object):
     def __eq__(self, other):
         if not isinstance(other, Version):
             return NotImplemented
-        # Treat missing components as zero
-        l = max(len(self.components), len(other.components))
-        sc = self.components + ((0,) * (l - len(self.components)))
-        oc = other.components + ((0,) * (l - len(other.components)))
-        if sc != oc:
-            return False
-        return all(getattr(self, attr) == getattr(other, attr)
-                   for attr in ['suffix', 'alpha', 'beta', 'pre',
-                                'rc', 'p', 'revision'])
+        return self._key == other._key
 
     def __lt__(self, other):
         if not isinstance(other, Version):
             return NotImplemented
-        # Treat missing components as zero
-        l = max(len(self.components), len(other.components))
-        sc = self.components + ((0,) * (l - len(self.components)))
-        oc = other.components + ((0,) * (l - len(other.components)))
-        if sc != oc:
-            return sc < oc
-        if self.suffix != other.suffix:
-            return self.suffix < other.suffix
-        for attr, sign in [('alpha', -1), ('beta', -1), ('pre', -1),
-                           ('rc', -1), ('p', 1), ('revision', 1)]:
-            if (sa := getattr(self, attr)) != (oa := getattr(other, attr)):
-                if sa is not None and oa is not None:
-                    return sa < oa
-                else:
-                    return sign*int(sa is not None) < sign*int(oa is not None)
-        # Here we have equality
-        return False
+        return self._key < other._key
 
     def __hash__(self):
-        # Be careful as we treat missing components as zero, so existing zeros
-        # need to be dropped
-        normalized_components = tuple(reversed(self.components))
-        while normalized_components and normalized_components[0] == 0:
-            normalized_components = normalized_components[1:]
-        data = (normalized_components) + tuple(
-            getattr(self, attr) for attr in ['suffix', 'alpha', 'beta', 'pre',
-                                             'rc', 'p', 'revision'])
-        return hash(data)
+        return hash(self._key)
 
     def serialize(self):
         return str(self)
 
     @classmethod
     def deserialize(cls, value):
-        mo = re.fullmatch(
-            r'([0-9\.]+)([a-z])?(?:_alpha([0-9]+))?(?:_beta([0-9]+))?'
-            r'(?:_pre([0-9]+))?(?:_rc([0-9]+))?(?:_p([0-9]+))?(?:-r([0-9]+))?',
-            value)
+        mo = _VER_RE.fullmatch(value)
         (rawcomponents, rawsuffix, rawalpha, rawbeta, rawpre, rawrc, rawp,
          rawrevision) = mo.groups()
         components = tuple(map(int, rawcomponents.split('.')))
@@ -33,6 +33,52 @@ class Logger(object):
         self.out.ewarn(message)
 
 
+class LogBuffer(object):
+    """
+    Collects info messages and passes them to a logger in batches.
+
+    Can be used as a context manager, pending messages are flushed on exit.
+    """
+
+    __slots__ = ('logger', 'size', 'messages')
+
+    def __init__(self, logger, size = 256):
+        """
+        Args:
+            logger: Logger to pass messages to.
+            size: Number of messages in a batch.
+        """
+        self.logger = logger
+        self.size = size
+        self.messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def info(self, message):
+        """
+        Add an info message.
+
+        Args:
+            message: Message.
+        """
+        self.messages.append(message)
+        if len(self.messages) >= self.size:
+            self.flush()
+
+    def flush(self):
+        """
+        Pass pending messages to the logger as a single message.
+        """
+        if self.messages:
+            # align continuation lines with the " * " prefix of einfo
+            self.logger.info('\n   '.join(self.messages))
+            self.messages = []
+
+
 class ProgressBar(object):
     """
     A progress bar for CLI
@@ -48,6 +48,10 @@ class PackageDB(object):
                 packages -- dictionary with packages (content of category dictionary in v. 0)
 
     For DB layout v. 0 only DB structure v. 0 is possible.
+
+    The generation attribute is incremented whenever package data (packages
+    or category common data) changes, so callers can tell whether data
+    derived from the DB is stale.
     """
 
     class Iterator(object):
@@ -170,6 +174,7 @@ class PackageDB(object):
         self.preferred_db_version = preferred_db_version
         self.preferred_category_format = preferred_category_format
         self.db_layout = DBLayout(self.directory)
+        self.generation = 0
         self.reset_db()
 
 
@@ -183,6 +188,7 @@ class PackageDB(object):
         """
         self.database = {}
         self.categories = {}
+        self.generation += 1
 
 
     def sync(self, db_uri, repository_config = None, sync_method="tgz"):
@@ -265,6 +271,7 @@ class PackageDB(object):
 
         db_version = metadata['db_version']
         self.database = packages
+        self.generation += 1
         if db_version == 0:
             for category, cat_data in self.database.items():
                 self.database[category] = {'common_data': {}, 'packages': cat_data}
@@ -302,6 +309,7 @@ class PackageDB(object):
             self.database[category] = {'common_data': common_data, 'packages': {}}
         else:
             self.database[category]['common_data'] = common_data
+        self.generation += 1
 
 
     def get_common_data(self, category):
@@ -351,6 +359,7 @@ class PackageDB(object):
             self.database[category]['packages'][name] = {}
 
         self.database[category]['packages'][name][version] = ebuild_data
+        self.generation += 1
 
 
     def list_categories(self):
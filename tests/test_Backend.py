@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    test_Backend.py
+    ~~~~~~~~~~~~~~~
+
+    Backend dependency resolution test suite
+
+    :copyright: (c) 2013-2015 by Jauhien Piatlicki
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import unittest
+
+from g_sorcery.backend import Backend
+from g_sorcery.exceptions import DependencyError
+from g_sorcery.g_collections import Dependency, Package
+from g_sorcery.package_db import DBGenerator, PackageDB
+
+from tests.base import BaseTest
+
+
+class DummyDBGenerator(DBGenerator):
+    pass
+
+
+class TestBackend(BaseTest):
+
+    def setUp(self):
+        super(TestBackend, self).setUp()
+        self.backend = Backend(DummyDBGenerator, None, None, None, None)
+        self.pkg_db = PackageDB(self.tempdir.name)
+        for category in ["app-test1", "app-test2"]:
+            self.pkg_db.add_category(category)
+
+    def add(self, category, name, version, dependencies):
+        self.pkg_db.add_package(Package(category, name, version),
+                                {"dependencies": [Dependency(*dep)
+                                                  for dep in dependencies]})
+
+    def names(self, packages):
+        return sorted(str(package) for package in packages)
+
+    def test_acyclic(self):
+        self.add("app-test1", "a", "1", [("app-test1", "b"), ("app-test2", "c")])
+        self.add("app-test1", "a", "2", [("app-test1", "b")])
+        self.add("app-test1", "b", "1", [("app-test2", "c")])
+        self.add("app-test1", "b", "2", [])
+        self.add("app-test2", "c", "1", [])
+        self.add("app-test2", "unrelated", "1", [])
+        self.assertEqual(self.names(self.backend.get_dependencies(self.pkg_db, "a")),
+                         ["app-test1/a-1", "app-test1/a-2", "app-test1/b-1",
+                          "app-test1/b-2", "app-test2/c-1"])
+        self.assertEqual(self.names(self.backend.get_dependencies(self.pkg_db,
+                                                                  "app-test1/b")),
+                         ["app-test1/b-1", "app-test1/b-2", "app-test2/c-1"])
+
+    def test_cyclic(self):
+        self.add("app-test1", "a", "1", [("app-test1", "b")])
+        self.add("app-test1", "b", "1", [("app-test2", "c")])
+        self.add("app-test2", "c", "1", [("app-test1", "a")])
+        self.add("app-test2", "d", "1", [("app-test1", "a")])
+        cycle = ["app-test1/a-1", "app-test1/b-1", "app-test2/c-1"]
+        for name in ["a", "d"]:
+            with self.assertRaises(DependencyError) as context:
+                self.backend.get_dependencies(self.pkg_db, name)
+            culprit = str(context.exception).rsplit(" ", 1)[-1]
+            self.assertIn(culprit, cycle)
+
+    def test_cyclic_name(self):
+        # the first package alphabetically is not part of the cycle
+        self.add("app-test1", "a", "1", [("app-test1", "b")])
+        self.add("app-test1", "b", "1", [("app-test2", "c")])
+        self.add("app-test2", "c", "1", [("app-test1", "b")])
+        with self.assertRaises(DependencyError) as context:
+            self.backend.get_dependencies(self.pkg_db, "a")
+        culprit = str(context.exception).rsplit(" ", 1)[-1]
+        self.assertIn(culprit, ["app-test1/b-1", "app-test2/c-1"])
+
+    def test_missing(self):
+        self.add("app-test1", "a", "1", [("app-test1", "b"),
+                                         ("app-test2", "nonexistent"),
+                                         ("app-test3", "nonexistent")])
+        self.add("app-test1", "b", "1", [])
+        self.assertEqual(self.names(self.backend.get_dependencies(self.pkg_db, "a")),
+                         ["app-test1/a-1", "app-test1/b-1"])
+        self.assertRaises(DependencyError,
+                          self.backend.get_dependencies, self.pkg_db, "nonexistent")
+
+    def test_solved_deps(self):
+        self.add("app-test1", "a", "1", [("app-test1", "b")])
+        self.add("app-test1", "b", "1", [("app-test2", "c")])
+        self.add("app-test2", "c", "1", [])
+        self.add("app-test2", "d", "1", [("app-test2", "c")])
+        solved_deps = set()
+        result = self.backend.get_dependencies(self.pkg_db, "b", solved_deps)
+        self.assertIs(result, solved_deps)
+        self.assertEqual(self.names(solved_deps),
+                         ["app-test1/b-1", "app-test2/c-1"])
+        self.backend.get_dependencies(self.pkg_db, "a", solved_deps)
+        self.backend.get_dependencies(self.pkg_db, "d", solved_deps)
+        self.assertEqual(self.names(solved_deps),
+                         ["app-test1/a-1", "app-test1/b-1",
+                          "app-test2/c-1", "app-test2/d-1"])
+        # already solved packages are not expanded again
+        self.assertEqual(self.names(self.backend.get_dependencies(
+            self.pkg_db, "a", {Package("app-test1", "b", "1")})),
+                         ["app-test1/a-1", "app-test1/b-1"])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestBackend('test_acyclic'))
+    suite.addTest(TestBackend('test_cyclic'))
+    suite.addTest(TestBackend('test_cyclic_name'))
+    suite.addTest(TestBackend('test_missing'))
+    suite.addTest(TestBackend('test_solved_deps'))
+    return suite
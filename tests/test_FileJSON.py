@@ -15,6 +15,7 @@ import json
 import os
 import unittest
 
+from g_sorcery import fileutils
 from g_sorcery.fileutils import FileJSON
 from g_sorcery.exceptions import FileJSONError
 from g_sorcery.g_collections import serializable_elist
@@ -83,6 +84,25 @@ class TestFileJSON(BaseTest):
         content_r = fj.read()
         self.assertEqual(content, content_r)
 
+    def test_non_ascii(self):
+        content = {"author": "Jos\u00e9", "description": "\u4e2d\u6587"}
+        orjson = fileutils.orjson
+        # files written with and without orjson must be readable by both
+        backends = [orjson, None] if orjson else [None]
+        try:
+            for writer in backends:
+                for reader in backends:
+                    fileutils.orjson = writer
+                    FileJSON(self.directory, self.name, []).write(content)
+                    with open(self.path, 'rb') as f:
+                        raw = f.read()
+                    self.assertEqual(json.loads(raw.decode('utf-8')), content)
+                    fileutils.orjson = reader
+                    content_r = FileJSON(self.directory, self.name, []).read()
+                    self.assertEqual(content_r, content)
+        finally:
+            fileutils.orjson = orjson
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestFileJSON('test_read_nonexistent'))
@@ -93,4 +113,5 @@ def suite():
     suite.addTest(TestFileJSON('test_serializable'))
     suite.addTest(TestFileJSON('test_deserializable'))
     suite.addTest(TestFileJSON('test_deserializable_collection'))
+    suite.addTest(TestFileJSON('test_non_ascii'))
     return suite
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    test_fast_manifest.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    fast_manifest test suite
+
+    :copyright: (c) 2013-2015 by Jauhien Piatlicki
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import hashlib
+import os
+import unittest
+
+from g_sorcery.fileutils import fast_manifest
+
+from tests.base import BaseTest
+
+
+class TestFastManifest(BaseTest):
+
+    def setUp(self):
+        super(TestFastManifest, self).setUp()
+        self.directory = self.tempdir.name
+        self.manifest = os.path.join(self.directory, "Manifest")
+        os.makedirs(os.path.join(self.directory, "files"))
+        self.files = {"test-1.ebuild": "EBUILD",
+                      "metadata.xml": "MISC",
+                      os.path.join("files", "test.patch"): "AUX"}
+        for name in self.files:
+            self.write(name, name)
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+
+    def read_manifest(self):
+        entries = {}
+        with open(self.manifest) as f:
+            for line in f.read().splitlines():
+                fields = line.split(" ")
+                entries[fields[1]] = fields
+        return entries
+
+    def expected(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            data = f.read()
+        return [self.files[name], os.path.basename(name), str(len(data)),
+                "BLAKE2B", hashlib.blake2b(data).hexdigest(),
+                "SHA512", hashlib.sha512(data).hexdigest()]
+
+    def age_files(self, mtime):
+        for name in self.files:
+            path = os.path.join(self.directory, name)
+            os.utime(path, ns=(mtime, mtime))
+
+    def forge_hashes(self):
+        """
+        Replace hashes in Manifest with fake ones and make it newer
+        than all the files.
+        """
+        entries = self.read_manifest()
+        with open(self.manifest, 'w') as f:
+            for fields in entries.values():
+                f.write(" ".join(fields[:3] + ["BLAKE2B", "forged",
+                                               "SHA512", "forged"]) + "\n")
+        self.age_files(os.stat(self.manifest).st_mtime_ns - 10**9)
+
+    def test_manifest(self):
+        with open(self.manifest, 'w') as f:
+            f.write("DIST test-1.tar.gz 1 BLAKE2B b SHA512 s\n")
+        fast_manifest(self.directory)
+        entries = self.read_manifest()
+        for name in self.files:
+            self.assertEqual(entries[os.path.basename(name)],
+                             self.expected(name))
+        self.assertEqual(entries["test-1.tar.gz"][0], "DIST")
+        with open(self.manifest) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, sorted(lines))
+
+    def test_reuse_unchanged(self):
+        fast_manifest(self.directory)
+        self.forge_hashes()
+        fast_manifest(self.directory)
+        for fields in self.read_manifest().values():
+            self.assertEqual(fields[4], "forged")
+            self.assertEqual(fields[6], "forged")
+
+    def test_rehash_changed(self):
+        fast_manifest(self.directory)
+        self.forge_hashes()
+        mtime = os.stat(self.manifest).st_mtime_ns
+        # modified after the Manifest, same size
+        self.write("test-1.ebuild", "test-2.ebuild", mtime + 10**9)
+        # modified before the Manifest, different size
+        self.write("metadata.xml", "<metadata/>", mtime - 10**9)
+        fast_manifest(self.directory)
+        entries = self.read_manifest()
+        self.assertEqual(entries["test-1.ebuild"],
+                         self.expected("test-1.ebuild"))
+        self.assertEqual(entries["metadata.xml"],
+                         self.expected("metadata.xml"))
+        self.assertEqual(entries["test.patch"][4], "forged")
+
+    def test_rehash_missing_hash(self):
+        fast_manifest(self.directory, hashes=("BLAKE2B",))
+        self.age_files(os.stat(self.manifest).st_mtime_ns - 10**9)
+        fast_manifest(self.directory)
+        entries = self.read_manifest()
+        for name in self.files:
+            self.assertEqual(entries[os.path.basename(name)],
+                             self.expected(name))
+
+    def test_foreign_lines(self):
+        with open(self.manifest, 'w') as f:
+            f.write("-----BEGIN PGP SIGNED MESSAGE-----\n"
+                    "Hash: SHA512\n"
+                    "\n"
+                    "EBUILD test-1.ebuild\n"
+                    "DIST test-1.tar.gz 1 BLAKE2B b SHA512 s\n"
+                    "-----BEGIN PGP SIGNATURE-----\n"
+                    "-----END PGP SIGNATURE-----\n")
+        fast_manifest(self.directory)
+        entries = self.read_manifest()
+        for name in self.files:
+            self.assertEqual(entries[os.path.basename(name)],
+                             self.expected(name))
+        self.assertEqual(entries["test-1.tar.gz"][0], "DIST")
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestFastManifest('test_manifest'))
+    suite.addTest(TestFastManifest('test_reuse_unchanged'))
+    suite.addTest(TestFastManifest('test_rehash_changed'))
+    suite.addTest(TestFastManifest('test_rehash_missing_hash'))
+    suite.addTest(TestFastManifest('test_foreign_lines'))
+    return suite
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    test_g_collections.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    g_collections test suite
+
+    :copyright: (c) 2013-2015 by Jauhien Piatlicki
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import itertools
+import random
+import unittest
+
+from g_sorcery.g_collections import serializable_elist, Version
+
+from tests.base import BaseTest
+
+
+class TestSerializableElist(BaseTest):
+
+    def test_serialize(self):
+        lst = serializable_elist(["a", "b"], separator="\n\t")
+        self.assertEqual(lst.serialize(),
+                         {"separator": "\n\t", "data": ["a", "b"]})
+
+    def test_deserialize(self):
+        for value in ({"separator": ",", "data": ["a", "b"]},
+                      [",", ["a", "b"]]):
+            lst = serializable_elist.deserialize(value)
+            self.assertEqual(lst, serializable_elist(["a", "b"], ","))
+            self.assertEqual(str(lst), "a,b")
+
+
+def reference_lt(a, b):
+    """
+    Version ordering as implemented before comparison keys were introduced.
+    """
+    l = max(len(a.components), len(b.components))
+    ac = a.components + ((0,) * (l - len(a.components)))
+    bc = b.components + ((0,) * (l - len(b.components)))
+    if ac != bc:
+        return ac < bc
+    if a.suffix != b.suffix:
+        return a.suffix < b.suffix
+    for attr, sign in [('alpha', -1), ('beta', -1), ('pre', -1),
+                       ('rc', -1), ('p', 1), ('revision', 1)]:
+        sa, sb = getattr(a, attr), getattr(b, attr)
+        if sa != sb:
+            if sa is not None and sb is not None:
+                return sa < sb
+            return sign*int(sa is not None) < sign*int(sb is not None)
+    return False
+
+
+class TestVersion(BaseTest):
+
+    def test_formatted(self):
+        for value in ["1", "0.1", "1.2.0b", "1.0_alpha1", "2_beta3_pre4",
+                      "3.1_rc2", "1.2.3_p4-r5", "1_alpha1_beta2_pre3_rc4_p5-r6"]:
+            version = Version.deserialize(value)
+            self.assertEqual(str(version), value)
+            self.assertEqual(version.serialize(), value)
+            self.assertEqual(Version.deserialize(version.serialize()), version)
+
+    def test_order(self):
+        ordered = ["1.0_alpha1", "1.0_alpha2", "1.0_beta1", "1.0_pre1",
+                   "1.0_rc1", "1.0", "1.0-r1", "1.0_p1", "1.0a", "1.0.1",
+                   "1.1", "2"]
+        versions = [Version.deserialize(value) for value in ordered]
+        for a, b in zip(versions, versions[1:]):
+            self.assertLess(a, b)
+            self.assertGreater(b, a)
+            self.assertNotEqual(a, b)
+        shuffled = list(versions)
+        random.Random(0).shuffle(shuffled)
+        self.assertEqual(sorted(shuffled), versions)
+
+    def test_trailing_zeros(self):
+        self.assertEqual(Version((1,)), Version((1, 0, 0)))
+        self.assertEqual(hash(Version((1,))), hash(Version((1, 0, 0))))
+        self.assertEqual(Version((1, 0), revision=1), Version((1,), revision=1))
+        self.assertLess(Version((1,)), Version((1, 0, 1)))
+        self.assertEqual(len({Version((1,)), Version((1, 0)), Version((1, 0, 1))}), 2)
+
+    def test_reference_order(self):
+        rng = random.Random(1)
+        def part():
+            return rng.choice([None, None, 0, 1, 2])
+        versions = [Version(tuple(rng.choice([0, 0, 1, 2])
+                                  for _ in range(rng.randint(1, 4))),
+                            rng.choice(["", "", "a", "b"]),
+                            part(), part(), part(), part(), part(), part())
+                    for _ in range(200)]
+        for a, b in itertools.product(versions, repeat=2):
+            self.assertEqual(a < b, reference_lt(a, b), (str(a), str(b)))
+            equal = not reference_lt(a, b) and not reference_lt(b, a)
+            self.assertEqual(a == b, equal, (str(a), str(b)))
+            if equal:
+                self.assertEqual(hash(a), hash(b))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestSerializableElist('test_serialize'))
+    suite.addTest(TestSerializableElist('test_deserialize'))
+    suite.addTest(TestVersion('test_formatted'))
+    suite.addTest(TestVersion('test_order'))
+    suite.addTest(TestVersion('test_trailing_zeros'))
+    suite.addTest(TestVersion('test_reference_order'))
+    return suite